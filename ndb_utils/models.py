@@ -4,8 +4,13 @@ Various helpers for managing models
 
 from __future__ import unicode_literals, print_function
 
+import time
+import zlib
 import random
+import logging
+import datetime
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 import formencode
@@ -14,6 +19,15 @@ from .exceptions import *
 
 MAX_RAND = 999999999999
 RAND_SAMPLE_SIZE = 10
+TOUCH_NAMESPACE = 'ndb_utils.touch'
+TOUCH_TIMEOUT = 24 * 3600
+TOUCH_BATCH_SIZE = 100
+TOUCH_CAS_RETRIES = 10
+TOUCH_SHARDS = 16
+TOUCH_SHARD_SIZE = 5000
+PURGE_NAMESPACE = 'ndb_utils.purge'
+PURGE_BATCH_SIZE = 500
+PURGE_BUCKETS = 4
 
 
 __all__ = ['ValidationError', 'TimestampedMixin', 'RandomMixin',
@@ -26,17 +40,286 @@ class TimestampedMixin(object):
     created = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True)
 
+    ttl = None
+    ttl_property = 'updated'
+
+    def touch(self):
+        """ Bumps ``updated`` in memcache without writing to datastore
+
+        The entity is queued for the next ``flush_touches()`` call. Touching
+        an entity that is already queued only updates its queued timestamp.
+        """
+        if self.key is None:
+            raise ModelError('Cannot touch %s that was never saved' %
+                             self._get_kind())
+        now = datetime.datetime.utcnow()
+        urlsafe = self.key.urlsafe()
+        memcache.set(urlsafe, now, time=TOUCH_TIMEOUT,
+                     namespace=TOUCH_NAMESPACE)
+        if not self._queue_touch(urlsafe, now):
+            logging.warning('Could not queue touch for %s', urlsafe)
+        self.updated = now
+        return self
+
+    def touched(self):
+        """ Returns the pending touch timestamp if there is one """
+        if self.key is None:
+            return None
+        return memcache.get(self.key.urlsafe(), namespace=TOUCH_NAMESPACE)
+
+    @classmethod
+    def apply_touches(cls, entities):
+        """ Overlays pending touch timestamps using a single memcache lookup
+
+        Returns the entities that were passed in. ``None`` items (as returned
+        by ``ndb.get_multi()`` for missing keys) are left as they are.
+        """
+        saved = [e for e in entities if e is not None and e.key is not None]
+        touched = memcache.get_multi([e.key.urlsafe() for e in saved],
+                                     namespace=TOUCH_NAMESPACE)
+        for entity in saved:
+            timestamp = touched.get(entity.key.urlsafe())
+            if timestamp and (entity.updated is None or
+                              timestamp > entity.updated):
+                entity.updated = timestamp
+        return entities
+
+    @classmethod
+    def flush_touches(cls, batch_size=TOUCH_BATCH_SIZE):
+        """ Writes pending touches to datastore and returns the count
+
+        Each entity is re-read and saved in its own transaction, so changes
+        made since the touch are not overwritten. Keys are removed from the
+        queue only after they are written, and failed keys are retried on the
+        next call. Keys touched again after they were read from the queue
+        stay queued for the next call.
+        """
+        shard_keys = [cls._touch_shard_key(i) for i in range(TOUCH_SHARDS)]
+        shards = memcache.get_multi(shard_keys, namespace=TOUCH_NAMESPACE)
+        flushed = 0
+        for shard_key in shard_keys:
+            pending = shards.get(shard_key) or {}
+            urlsafes = sorted(pending)
+            for i in range(0, len(urlsafes), batch_size):
+                batch = urlsafes[i:i + batch_size]
+                futures = [cls._flush_touch_async(ndb.Key(urlsafe=k))
+                           for k in batch]
+                ndb.Future.wait_all(futures)
+                written = {}
+                for urlsafe, future in zip(batch, futures):
+                    error = future.get_exception()
+                    if error is not None:
+                        logging.warning('Could not flush touch for %s: %s',
+                                        urlsafe, error)
+                        continue
+                    written[urlsafe] = pending[urlsafe]
+                    flushed += future.get_result()
+                cls._unqueue_touches(shard_key, written)
+        return flushed
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _flush_touch_async(cls, key):
+        """ Re-reads and saves entity so that ``updated`` is bumped """
+        entity = yield key.get_async()
+        if entity is None:
+            raise ndb.Return(0)
+        yield entity.put_async()
+        raise ndb.Return(1)
+
+    @classmethod
+    def _touch_shard_key(cls, shard):
+        return 'pending:%s:%s' % (cls._get_kind(), shard)
+
+    @classmethod
+    def _queue_touch(cls, urlsafe, timestamp):
+        """ Records entity key and touch time in its shard of pending touches
+
+        Returns ``False`` if the key could not be queued.
+        """
+        client = memcache.Client()
+        shard_key = cls._touch_shard_key(zlib.crc32(urlsafe) % TOUCH_SHARDS)
+        for i in range(TOUCH_CAS_RETRIES):
+            pending = client.gets(shard_key, namespace=TOUCH_NAMESPACE)
+            if pending is None:
+                if client.add(shard_key, {urlsafe: timestamp},
+                              namespace=TOUCH_NAMESPACE):
+                    return True
+                continue
+            if urlsafe in pending and pending[urlsafe] >= timestamp:
+                return True
+            if urlsafe not in pending and len(pending) >= TOUCH_SHARD_SIZE:
+                return False
+            pending[urlsafe] = timestamp
+            if client.cas(shard_key, pending, namespace=TOUCH_NAMESPACE):
+                return True
+        return False
+
+    @classmethod
+    def _unqueue_touches(cls, shard_key, written):
+        """ Removes written keys from a shard of pending touches
+
+        ``written`` maps keys to the touch times that were flushed. Keys that
+        were touched again since then are left in the queue.
+        """
+        if not written:
+            return
+        client = memcache.Client()
+        for i in range(TOUCH_CAS_RETRIES):
+            pending = client.gets(shard_key, namespace=TOUCH_NAMESPACE)
+            if not pending:
+                return
+            for urlsafe, timestamp in written.items():
+                if urlsafe in pending and pending[urlsafe] <= timestamp:
+                    del pending[urlsafe]
+            if client.cas(shard_key, pending, namespace=TOUCH_NAMESPACE):
+                return
+        logging.warning('Could not unqueue flushed touches from %s',
+                        shard_key)
+
+    @classmethod
+    def purge_expired(cls, buckets=PURGE_BUCKETS, batch_size=PURGE_BATCH_SIZE,
+                      max_batches=None):
+        """ Deletes entities whose ``ttl`` has expired and returns stats
+
+        The expired time range is split into ``buckets`` that are paged
+        through in parallel using keys-only queries. Progress is checkpointed
+        in memcache after each round of deletes, so a run interrupted by
+        ``max_batches`` or an error resumes from the last completed round on
+        the next call. When ``ttl_property`` is ``'updated'``, entities with
+        a pending touch newer than the cutoff are kept.
+        """
+        if cls.ttl is None:
+            raise ModelError('%s does not define ttl' % cls._get_kind())
+        prop = getattr(cls, cls.ttl_property)
+        check_touches = cls.ttl_property == 'updated'
+        started = time.time()
+        deleted = 0
+        batches = 0
+
+        checkpoint = cls._load_purge_checkpoint(prop, buckets)
+        deletes = []
+        while (checkpoint['buckets'] and
+               (max_batches is None or batches < max_batches)):
+            pages = []
+            for bucket in checkpoint['buckets']:
+                cursor = bucket['cursor']
+                query = cls.query(prop >= bucket['start'],
+                                  prop < bucket['end'])
+                pages.append(query.fetch_page_async(
+                    batch_size, keys_only=True,
+                    start_cursor=cursor and ndb.Cursor(urlsafe=cursor)))
+            # Deletes from the previous round run while the next pages load
+            ndb.Future.wait_all(deletes)
+            cls._save_purge_checkpoint(checkpoint)
+            deletes = []
+            remaining = []
+            for bucket, page in zip(checkpoint['buckets'], pages):
+                keys, cursor, more = page.get_result()
+                if check_touches:
+                    keys = cls._untouched_since(keys, checkpoint['cutoff'])
+                deletes.extend(ndb.delete_multi_async(keys))
+                deleted += len(keys)
+                if more and cursor:
+                    bucket['cursor'] = cursor.urlsafe()
+                    remaining.append(bucket)
+            checkpoint['buckets'] = remaining
+            batches += 1
+        ndb.Future.wait_all(deletes)
+        cls._save_purge_checkpoint(checkpoint)
+
+        elapsed = time.time() - started
+        return {
+            'deleted': deleted,
+            'batches': batches,
+            'elapsed': elapsed,
+            'rate': deleted / elapsed if elapsed else 0.0,
+            'done': not checkpoint['buckets'],
+        }
+
+    @classmethod
+    def _load_purge_checkpoint(cls, prop, buckets):
+        """ Returns saved checkpoint or splits the expired time range
+
+        The expired range is split into ``buckets`` equal ranges.
+        """
+        checkpoint = memcache.get(cls._get_kind(), namespace=PURGE_NAMESPACE)
+        if checkpoint is not None:
+            return checkpoint
+        ttl = cls.ttl
+        if not isinstance(ttl, datetime.timedelta):
+            ttl = datetime.timedelta(seconds=ttl)
+        cutoff = datetime.datetime.utcnow() - ttl
+        checkpoint = {'cutoff': cutoff, 'buckets': []}
+        oldest = cls.query(prop < cutoff).order(prop).get(projection=[prop])
+        if oldest is None:
+            return checkpoint
+        start = getattr(oldest, prop._code_name)
+        step = (cutoff - start) / buckets
+        bounds = [start + step * i for i in range(buckets)] + [cutoff]
+        checkpoint['buckets'] = [
+            {'start': bounds[i], 'end': bounds[i + 1], 'cursor': None}
+            for i in range(buckets)]
+        return checkpoint
+
+    @classmethod
+    def _save_purge_checkpoint(cls, checkpoint):
+        """ Stores unfinished checkpoint or clears finished one """
+        if checkpoint['buckets']:
+            memcache.set(cls._get_kind(), checkpoint,
+                         namespace=PURGE_NAMESPACE)
+        else:
+            memcache.delete(cls._get_kind(), namespace=PURGE_NAMESPACE)
+
+    @classmethod
+    def _untouched_since(cls, keys, cutoff):
+        """ Returns keys without a pending touch newer than ``cutoff`` """
+        touched = memcache.get_multi([k.urlsafe() for k in keys],
+                                     namespace=TOUCH_NAMESPACE)
+        fresh = set(urlsafe for urlsafe, timestamp in touched.items()
+                    if timestamp >= cutoff)
+        return [k for k in keys if k.urlsafe() not in fresh]
+
 
 class RandomMixin(object):
     """ Mixin that allows fetching of random entity """
 
     random_id = ndb.IntegerProperty(required=True)
 
+    random_filters = []
+
     @classmethod
-    def random(cls):
+    def random(cls, *filters):
+        """ Returns random entity matching optional equality filters
+
+        Only keys are sampled, and the entity is fetched by key. If there are
+        no entities above the random threshold, the lookup wraps around to the
+        lowest ``random_id``. Returns ``None`` if no entity matches.
+        """
         r = cls.generate_random()
-        sample = cls.query(cls.random_id > r).fetch(RAND_SAMPLE_SIZE)
-        return random.choice(sample)
+        query = cls.query(*filters).order(cls.random_id)
+        sample = query.filter(cls.random_id > r).fetch(RAND_SAMPLE_SIZE,
+                                                       keys_only=True)
+        if not sample:
+            sample = query.fetch(RAND_SAMPLE_SIZE, keys_only=True)
+        if not sample:
+            return None
+        return random.choice(sample).get()
+
+    @classmethod
+    def random_indexes(cls):
+        """ Returns index.yaml definitions needed by filtered ``random()`` """
+        kind = cls._get_kind()
+        indexes = []
+        for props in cls.random_filters:
+            if isinstance(props, basestring):
+                props = [props]
+            lines = ['- kind: %s' % kind, '  properties:']
+            for prop in props:
+                lines.append('  - name: %s' % getattr(cls, prop)._name)
+            lines.append('  - name: random_id')
+            indexes.append('\n'.join(lines))
+        return '\n\n'.join(indexes)
 
     @classmethod
     def generate_random(cls):
@@ -1,13 +1,23 @@
 from __future__ import unicode_literals, print_function
 
 import re
+import time
+import hashlib
 from decimal import Decimal
 
 import formencode
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 
+from .exceptions import ModelError
+
+
+AGGREGATE_NAMESPACE = 'ndb_utils.aggregate'
+AGGREGATE_BATCH_SIZE = 1000
+AGGREGATE_TIMEOUT = 3600
+
 
 __all__ = ['DecimalString', 'slug_validator', 'email_validator',
            'SlugProperty', 'EmailProperty', 'DecimalProperty']
@@ -103,3 +113,101 @@ class DecimalProperty(ndb.IntegerProperty):
     def _from_base_type(self, value):
         return Decimal(value) / (10 ** self.float_prec)
 
+    def aggregate(self, query, batch_size=AGGREGATE_BATCH_SIZE, cache=False):
+        """ Returns count, sum, min, max and avg of values matching query
+
+        Values are read from a projection query as stored integers and only
+        the results are converted to ``Decimal``. If ``cache`` is ``True``,
+        the result is cached until ``invalidate_aggregates()`` is called for
+        the query's kind.
+        """
+        return self._cached(query, 'aggregate', cache,
+                            lambda: self._aggregate(query, batch_size))
+
+    def sum(self, query, **kwargs):
+        """ Returns sum of values matching the query """
+        return self.aggregate(query, **kwargs)['sum']
+
+    def avg(self, query, **kwargs):
+        """ Returns average of values matching the query """
+        return self.aggregate(query, **kwargs)['avg']
+
+    def min(self, query, cache=False):
+        """ Returns smallest value matching the query """
+        return self._cached(query, 'min', cache,
+                            lambda: self._first_value(query, self))
+
+    def max(self, query, cache=False):
+        """ Returns largest value matching the query """
+        return self._cached(query, 'max', cache,
+                            lambda: self._first_value(query, -self))
+
+    @staticmethod
+    def invalidate_aggregates(kind):
+        """ Invalidates cached aggregates for specified kind """
+        memcache.incr(kind, initial_value=int(time.time() * 1000),
+                      namespace=AGGREGATE_NAMESPACE)
+
+    def _aggregate(self, query, batch_size):
+        """ Calculates aggregates from a projection on stored integers """
+        count = total = 0
+        low = high = None
+        for entity in query.iter(projection=[self], batch_size=batch_size):
+            value = self._get_base_value_unwrapped_as_list(entity)[0]
+            if value is None:
+                continue
+            count += 1
+            total += value
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+        return {
+            'count': count,
+            'sum': self._from_base_type(total),
+            'min': None if low is None else self._from_base_type(low),
+            'max': None if high is None else self._from_base_type(high),
+            'avg': self._from_base_type(total) / count if count else None,
+        }
+
+    def _first_value(self, query, order):
+        """ Returns value of the first non-null row in specified order """
+        if query.orders is not None:
+            raise ModelError('Cannot calculate min or max of an ordered query')
+        entity = query.filter(self > None).order(order).get(
+            projection=[self])
+        if entity is None:
+            return None
+        return getattr(entity, self._code_name)
+
+    def _cached(self, query, name, cache, calculate):
+        """ Returns cached result or calculates and caches a new one """
+        cache_key = cache and self._aggregate_cache_key(query, name)
+        if not cache_key:
+            return calculate()
+        cached = memcache.get(cache_key, namespace=AGGREGATE_NAMESPACE)
+        if cached is not None:
+            return cached[0]
+        result = calculate()
+        # Wrapped in a tuple so that ``None`` results are cached as well
+        memcache.set(cache_key, (result,), time=AGGREGATE_TIMEOUT,
+                     namespace=AGGREGATE_NAMESPACE)
+        return result
+
+    def _aggregate_cache_key(self, query, name):
+        """ Returns cache key for the query and current generation
+
+        The generation starts from current time so that results cached before
+        the generation was evicted are not reused. Returns ``None`` if
+        memcache is not available.
+        """
+        generation = memcache.get(query.kind, namespace=AGGREGATE_NAMESPACE)
+        if generation is None:
+            memcache.add(query.kind, int(time.time() * 1000),
+                         namespace=AGGREGATE_NAMESPACE)
+            generation = memcache.get(query.kind,
+                                      namespace=AGGREGATE_NAMESPACE)
+        if generation is None:
+            return None
+        digest = hashlib.md5(repr((name, self._name, query)).encode('utf-8'))
+        return '%s:%s:%s' % (query.kind, generation, digest.hexdigest())
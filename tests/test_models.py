@@ -1,3 +1,6 @@
+import datetime
+
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 import formencode
@@ -5,6 +8,8 @@ from formencode import validators
 import mock
 
 from ndb_utils.models import *
+from ndb_utils.models import MAX_RAND, TOUCH_SHARDS, TOUCH_NAMESPACE
+from ndb_utils.exceptions import ModelError
 
 from dbunit import DatastoreTestCase
 
@@ -18,6 +23,26 @@ class TestModel(RandomMixin, ndb.Model):
     pass
 
 
+class TestTimestampedModel(TimestampedMixin, ndb.Model):
+    pass
+
+
+class TestExpiringModel(TimestampedMixin, ndb.Model):
+    ttl = 3600
+    ttl_property = 'created'
+
+
+class TestSessionModel(TimestampedMixin, ndb.Model):
+    ttl = 3600
+
+
+class TestFilteredRandomModel(RandomMixin, ndb.Model):
+    category = ndb.StringProperty()
+    owner = ndb.StringProperty()
+
+    random_filters = ['category', ('owner', 'category')]
+
+
 class TestOwnerModel(OwnershipMixin, ndb.Model):
     pass
 
@@ -47,6 +72,150 @@ class TestUniqueModel(UniquePropertyMixin, ndb.Model):
     unique_properties = ['foo']
 
 
+class TimestampedMixinTestCase(DatastoreTestCase):
+    """ Tests for TimestampedMixin """
+
+    def pending_touches(self):
+        """ Helper method to list queued touches across all shards """
+        pending = []
+        for shard in range(TOUCH_SHARDS):
+            key = TestTimestampedModel._touch_shard_key(shard)
+            pending.extend(memcache.get(key, namespace=TOUCH_NAMESPACE) or {})
+        return pending
+
+    def test_touch_does_not_write(self):
+        """ Touching should not change the stored timestamp """
+        t = TestTimestampedModel()
+        t.put()
+        updated = t.updated
+        t.touch()
+        t1 = t.key.get(use_cache=False, use_memcache=False)
+        self.assertEqual(t1.updated, updated)
+        self.assertTrue(t.touched() >= updated)
+
+    def test_touch_unsaved(self):
+        """ Touching an entity that was never saved should raise """
+        with self.assertRaises(ModelError):
+            TestTimestampedModel().touch()
+
+    def test_apply_touches(self):
+        """ Reads should see the touched timestamp """
+        t = TestTimestampedModel()
+        t.put()
+        t.touch()
+        missing = ndb.Key('TestTimestampedModel', 'missing')
+        entities = TestTimestampedModel.apply_touches(ndb.get_multi(
+            [t.key, missing], use_cache=False, use_memcache=False))
+        self.assertEqual(entities[0].updated, t.touched())
+        self.assertEqual(entities[1], None)
+
+    def test_touches_are_coalesced(self):
+        """ Touching twice should queue entity only once """
+        t = TestTimestampedModel()
+        t.put()
+        t.touch()
+        t.touch()
+        self.assertEqual(self.pending_touches(), [t.key.urlsafe()])
+
+    def test_flush_touches(self):
+        """ Flushing should write touched entities in batches """
+        entities = [TestTimestampedModel() for i in range(5)]
+        ndb.put_multi(entities)
+        for t in entities:
+            t.touch()
+        touched = entities[0].touched()
+        self.assertEqual(TestTimestampedModel.flush_touches(batch_size=2), 5)
+        t1 = entities[0].key.get(use_cache=False, use_memcache=False)
+        self.assertTrue(t1.updated >= touched)
+        self.assertEqual(self.pending_touches(), [])
+        self.assertEqual(TestTimestampedModel.flush_touches(), 0)
+
+    def test_failed_flush_keeps_touches(self):
+        """ Touches that failed to flush should stay queued """
+        t = TestTimestampedModel()
+        t.put()
+        t.touch()
+
+        def fail(key):
+            future = ndb.Future()
+            future.set_exception(RuntimeError('write failed'))
+            return future
+
+        with mock.patch.object(TestTimestampedModel, '_flush_touch_async',
+                               side_effect=fail):
+            self.assertEqual(TestTimestampedModel.flush_touches(), 0)
+        self.assertEqual(self.pending_touches(), [t.key.urlsafe()])
+        self.assertEqual(TestTimestampedModel.flush_touches(), 1)
+
+    def test_touch_during_flush_stays_queued(self):
+        """ Touches made while flushing should not be dropped """
+        t = TestTimestampedModel()
+        t.put()
+        t.touch()
+        flush = TestTimestampedModel._flush_touch_async
+
+        def flush_and_touch(key):
+            future = flush(key)
+            future.get_result()
+            t.touch()
+            return future
+
+        with mock.patch.object(TestTimestampedModel, '_flush_touch_async',
+                               side_effect=flush_and_touch):
+            self.assertEqual(TestTimestampedModel.flush_touches(), 1)
+        self.assertEqual(self.pending_touches(), [t.key.urlsafe()])
+        self.assertEqual(TestTimestampedModel.flush_touches(), 1)
+        self.assertEqual(self.pending_touches(), [])
+
+    def create_expiring(self, count, age):
+        """ Helper method to create entities of specified age in hours """
+        created = datetime.datetime.utcnow() - datetime.timedelta(hours=age)
+        second = datetime.timedelta(seconds=1)
+        entities = [TestExpiringModel(created=created + i * second)
+                    for i in range(count)]
+        ndb.put_multi(entities)
+        return entities
+
+    def test_purge_requires_ttl(self):
+        """ Purging a model without ttl should raise """
+        with self.assertRaises(ModelError):
+            TestTimestampedModel.purge_expired()
+
+    def test_purge_expired(self):
+        """ Only expired entities should be purged """
+        self.create_expiring(10, 5)
+        fresh = self.create_expiring(3, 0)
+        stats = TestExpiringModel.purge_expired(batch_size=2)
+        self.assertEqual(stats['deleted'], 10)
+        self.assertTrue(stats['done'])
+        remaining = TestExpiringModel.query().fetch(keys_only=True)
+        self.assertEqual(sorted(remaining), sorted(e.key for e in fresh))
+
+    def test_purge_resumes_from_checkpoint(self):
+        """ Interrupted purge should resume on next call """
+        self.create_expiring(10, 5)
+        stats = TestExpiringModel.purge_expired(buckets=1, batch_size=2,
+                                                max_batches=2)
+        self.assertEqual(stats['deleted'], 4)
+        self.assertFalse(stats['done'])
+        stats = TestExpiringModel.purge_expired(buckets=1, batch_size=2)
+        self.assertEqual(stats['deleted'], 6)
+        self.assertTrue(stats['done'])
+        self.assertEqual(TestExpiringModel.query().count(), 0)
+
+    def test_purge_keeps_touched(self):
+        """ Entities with a fresh pending touch should not be purged """
+        updated = datetime.datetime.utcnow() - datetime.timedelta(hours=5)
+        sessions = [TestSessionModel(updated=updated) for i in range(3)]
+        with mock.patch.object(TestSessionModel.updated, '_auto_now', False):
+            ndb.put_multi(sessions)
+        sessions[0].touch()
+        stats = TestSessionModel.purge_expired()
+        self.assertEqual(stats['deleted'], 2)
+        remaining = TestSessionModel.query().fetch(keys_only=True)
+        self.assertEqual(remaining, [sessions[0].key])
+
+
 class RandomMixinTestCase(DatastoreTestCase):
     """ Tests for RandomMixin """
 
@@ -79,6 +248,54 @@ class RandomMixinTestCase(DatastoreTestCase):
         t2 = TestModel.random()
         self.assertNotEqual(t1, t2)
 
+    def test_get_random_filtered(self):
+        """ Random entity should match the filters """
+        for i in range(20):
+            TestFilteredRandomModel(category='foo').put()
+            TestFilteredRandomModel(category='bar').put()
+        for i in range(10):
+            t = TestFilteredRandomModel.random(
+                TestFilteredRandomModel.category == 'foo')
+            self.assertEqual(t.category, 'foo')
+
+    def test_get_random_wraps_around(self):
+        """ Should wrap around when threshold is above all random IDs """
+        TestModel().put()
+        with mock.patch.object(TestModel, 'generate_random') as gen:
+            gen.return_value = MAX_RAND
+            self.assertNotEqual(TestModel.random(), None)
+
+    def test_get_random_no_match(self):
+        """ Should return None when nothing matches the filters """
+        TestFilteredRandomModel(category='foo').put()
+        t = TestFilteredRandomModel.random(
+            TestFilteredRandomModel.category == 'baz')
+        self.assertEqual(t, None)
+
+    def test_random_indexes(self):
+        """ Should generate index definitions for declared filters """
+        self.assertEqual(TestFilteredRandomModel.random_indexes(),
+                         '- kind: TestFilteredRandomModel\n'
+                         '  properties:\n'
+                         '  - name: category\n'
+                         '  - name: random_id\n'
+                         '\n'
+                         '- kind: TestFilteredRandomModel\n'
+                         '  properties:\n'
+                         '  - name: owner\n'
+                         '  - name: category\n'
+                         '  - name: random_id')
+
+    def test_get_random_combined_filters(self):
+        """ Random entity should match all the filters """
+        for i in range(10):
+            TestFilteredRandomModel(category='foo', owner='bar').put()
+            TestFilteredRandomModel(category='foo', owner='baz').put()
+        t = TestFilteredRandomModel.random(
+            TestFilteredRandomModel.owner == 'bar',
+            TestFilteredRandomModel.category == 'foo')
+        self.assertEqual((t.owner, t.category), ('bar', 'foo'))
+
 
 class OwnershipMixinTestCase(DatastoreTestCase):
 
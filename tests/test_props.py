@@ -1,13 +1,18 @@
+import time
 import unittest
 from decimal import *
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 
 import formencode
 from formencode import validators
+import mock
 
 from ndb_utils.properties import *
+from ndb_utils.properties import AGGREGATE_NAMESPACE
+from ndb_utils.exceptions import ModelError
 
 from dbunit import DatastoreTestCase
 
@@ -176,6 +181,88 @@ class DecimalPropertyTestCase(DatastoreTestCase):
             self.assertNotEqual(entity, t)
 
 
+class DecimalAggregateTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(DecimalAggregateTestCase, self).setUp()
+        for value in ['1.25', '2.50', '4.75']:
+            TestDecPropModel(dec=value).put()
+        self.query = TestDecPropModel.query()
+
+    def test_aggregate(self):
+        """ should calculate all aggregates in one pass """
+        result = TestDecPropModel.dec.aggregate(self.query, batch_size=2)
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['sum'], Decimal('8.5'))
+        self.assertEqual(result['min'], Decimal('1.25'))
+        self.assertEqual(result['max'], Decimal('4.75'))
+        self.assertEqual(result['avg'], Decimal('8.5') / 3)
+
+    def test_aggregate_does_not_convert_values(self):
+        """ number of conversions should not grow with number of rows """
+        with mock.patch.object(DecimalProperty, '_from_base_type') as conv:
+            conv.return_value = Decimal('0')
+            TestDecPropModel.dec.aggregate(self.query)
+            conversions = conv.call_count
+            for i in range(10):
+                TestDecPropModel(dec='1').put()
+            conv.reset_mock()
+            TestDecPropModel.dec.aggregate(self.query)
+            self.assertEqual(conv.call_count, conversions)
+
+    def test_aggregate_empty(self):
+        """ should handle queries with no results """
+        query = TestDecPropModel.query(TestDecPropModel.dec > 100)
+        result = TestDecPropModel.dec.aggregate(query)
+        self.assertEqual(result['count'], 0)
+        self.assertEqual(result['sum'], Decimal('0'))
+        self.assertEqual(result['avg'], None)
+        self.assertEqual(result['min'], None)
+
+    def test_shortcuts(self):
+        """ should provide shortcuts for each aggregate """
+        self.assertEqual(TestDecPropModel.dec.sum(self.query), Decimal('8.5'))
+        self.assertEqual(TestDecPropModel.dec.min(self.query),
+                         Decimal('1.25'))
+        self.assertEqual(TestDecPropModel.dec.max(self.query),
+                         Decimal('4.75'))
+
+    def test_cached_aggregate(self):
+        """ cached result should be returned until invalidated """
+        dec = TestDecPropModel.dec
+        self.assertEqual(dec.sum(self.query, cache=True), Decimal('8.5'))
+        TestDecPropModel(dec='1.5').put()
+        self.assertEqual(dec.sum(self.query, cache=True), Decimal('8.5'))
+        DecimalProperty.invalidate_aggregates('TestDecPropModel')
+        self.assertEqual(dec.sum(self.query, cache=True), Decimal('10'))
+
+    def test_cache_survives_generation_eviction(self):
+        """ stale results should not be served if generation is evicted """
+        dec = TestDecPropModel.dec
+        self.assertEqual(dec.sum(self.query, cache=True), Decimal('8.5'))
+        TestDecPropModel(dec='1.5').put()
+        memcache.delete('TestDecPropModel', namespace=AGGREGATE_NAMESPACE)
+        later = time.time() + 1
+        with mock.patch('ndb_utils.properties.time') as clock:
+            clock.time.return_value = later
+            self.assertEqual(dec.sum(self.query, cache=True), Decimal('10'))
+
+    def test_cached_min_and_max(self):
+        """ min and max should also be cacheable """
+        dec = TestDecPropModel.dec
+        self.assertEqual(dec.min(self.query, cache=True), Decimal('1.25'))
+        TestDecPropModel(dec='0.5').put()
+        self.assertEqual(dec.min(self.query, cache=True), Decimal('1.25'))
+        DecimalProperty.invalidate_aggregates('TestDecPropModel')
+        self.assertEqual(dec.min(self.query, cache=True), Decimal('0.5'))
+
+    def test_min_of_ordered_query(self):
+        """ should raise a clear error for ordered queries """
+        query = self.query.order(TestDecPropModel.precise)
+        with self.assertRaises(ModelError):
+            TestDecPropModel.dec.min(query)
+
+
 if __name__ == '__main__':
     unittest.main()
 